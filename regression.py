@@ -0,0 +1,318 @@
+"""
+Regression harness for request forms, runs the pipeline on fixture dataset and compares branch files with golden files
+"""
+
+# import libraries
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from openpyxl.styles.numbers import BUILTIN_FORMATS
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
+
+import request_forms
+
+
+# fixture locations
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+FIXTURE_INPUT_DIR = os.path.join(FIXTURES_DIR, 'input')
+GOLDEN_DIR = os.path.join(FIXTURES_DIR, 'golden')
+
+# namespace of spreadsheet xml
+NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+# how many differences are shown for each file
+MAX_DIFFS = 20
+
+# scenarios run on fixture dataset, forms of each scenario are saved in its own directory
+FIXTURE_SCENARIOS = [
+    {'name': 'base'},
+    # branch warehouse as source, its own form is not prepared
+    {'name': 'branch source', 'central_storage_name': '1610000200 - მარჯანიშვილი საწყობი'},
+    # every code the branches hold is removed, total quantity is zero and summary formulas have no cached value
+    {'name': 'zero stock', 'remove_codes': 'remove_codes_branch_stock.xlsx'}
+]
+
+# run the pipeline on fixture dataset
+def run_fixture(output_dir):
+    """
+    output_dir - directory where branch files of each scenario are saved
+    """
+    scenarios = [dict(scenario,
+                      reserves=os.path.join(FIXTURE_INPUT_DIR, scenario.get('reserves', 'reserves.xlsx')),
+                      remove_codes=os.path.join(FIXTURE_INPUT_DIR, scenario.get('remove_codes', 'remove_codes.xlsx')),
+                      output_dir=os.path.join(output_dir, scenario['name']))
+                 for scenario in FIXTURE_SCENARIOS]
+
+    request_forms.batch(scenarios,
+                        evaluation_loc=os.path.join(FIXTURE_INPUT_DIR, 'product_evaluation.csv'),
+                        sales_loc=os.path.join(FIXTURE_INPUT_DIR, 'sales_cleaned.csv'),
+                        inventory_loc=os.path.join(FIXTURE_INPUT_DIR, 'inventory_clean.csv'),
+                        closing_inventory_loc=os.path.join(FIXTURE_INPUT_DIR, 'closing_inventory_margins.xlsx'),
+                        product_description_loc=os.path.join(FIXTURE_INPUT_DIR, 'product_description.xlsx'))
+
+# number format, fill and protection of each cell style
+def read_styles(zf):
+    """
+    zf - opened excel file
+    """
+    root = ET.fromstring(zf.read('xl/styles.xml'))
+
+    number_formats = dict(BUILTIN_FORMATS)
+    num_fmts = root.find(f'{NS}numFmts')
+    if num_fmts is not None:
+        for num_fmt in num_fmts:
+            number_formats[int(num_fmt.get('numFmtId'))] = num_fmt.get('formatCode')
+
+    fills = []
+    for fill in root.find(f'{NS}fills'):
+        pattern = fill.find(f'{NS}patternFill')
+        if pattern is None or pattern.get('patternType') in (None, 'none'):
+            fills.append(None)
+            continue
+        color = pattern.find(f'{NS}fgColor')
+        fills.append(f"{pattern.get('patternType')}:{'' if color is None else color.get('rgb') or color.get('theme')}")
+
+    styles = []
+    for xf in root.find(f'{NS}cellXfs'):
+        protection = xf.find(f'{NS}protection')
+        locked, hidden = True, False
+        if protection is not None:
+            locked = protection.get('locked', '1') in ('1', 'true')
+            hidden = protection.get('hidden', '0') in ('1', 'true')
+        styles.append({
+            'number_format': number_formats.get(int(xf.get('numFmtId', 0)), 'General'),
+            'fill': fills[int(xf.get('fillId', 0))],
+            'protection': f'locked={locked}, hidden={hidden}'
+        })
+
+    return styles
+
+# calculation properties of the workbook, they tell excel whether to recalculate formulas on open
+def read_calculation_properties(zf):
+    """
+    zf - opened excel file
+    """
+    calculation_properties = ET.fromstring(zf.read('xl/workbook.xml')).find(f'{NS}calcPr')
+
+    return {} if calculation_properties is None else dict(calculation_properties.attrib)
+
+# shared strings of excel file, openpyxl writes inline strings but excel saves shared strings
+def read_shared_strings(zf):
+    """
+    zf - opened excel file
+    """
+    if 'xl/sharedStrings.xml' not in zf.namelist():
+        return []
+
+    root = ET.fromstring(zf.read('xl/sharedStrings.xml'))
+    return [''.join(t.text or '' for t in si.iter(f'{NS}t')) for si in root]
+
+# stream cells of the sheet in order of rows, sheet settings are collected into sheet_info
+def iter_cells(zf, sheet_name, styles, shared_strings, sheet_info):
+    """
+    zf - opened excel file,
+    sheet_name - location of sheet xml in excel file,
+    styles - see read_styles,
+    shared_strings - see read_shared_strings,
+    sheet_info - dictionary filled with validation ranges and protection of the sheet
+    """
+    sheet_info['validations'] = []
+    sheet_info['protection'] = None
+
+    with zf.open(sheet_name) as f:
+        for event, element in ET.iterparse(f):
+            tag = element.tag.replace(NS, '')
+            if tag == 'c':
+                address = element.get('r')
+                column, row = coordinate_from_string(address)
+
+                cell_type = element.get('t', 'n')
+                value_element = element.find(f'{NS}v')
+                value = None if value_element is None else value_element.text
+                if cell_type == 'inlineStr':
+                    value = ''.join(t.text or '' for t in element.iter(f'{NS}t'))
+                elif cell_type == 's' and value is not None:
+                    value = shared_strings[int(value)]
+                elif cell_type == 'n' and value is not None:
+                    value = float(value)
+
+                formula_element = element.find(f'{NS}f')
+                style = styles[int(element.get('s', 0))]
+
+                yield (row, column_index_from_string(column)), address, {
+                    'value': value,
+                    'formula': None if formula_element is None else formula_element.text,
+                    'number_format': style['number_format'],
+                    'fill': style['fill'],
+                    'protection': style['protection']
+                }
+                element.clear()
+            elif tag == 'row':
+                element.clear()
+            elif tag == 'dataValidation':
+                formula = element.find(f'{NS}formula1')
+                sheet_info['validations'].append(
+                    (element.get('sqref'), element.get('type'), None if formula is None else formula.text))
+            elif tag == 'sheetProtection':
+                sheet_info['protection'] = dict(sorted(element.attrib.items()))
+
+# empty cell, used when cell exists only in one of the files
+EMPTY_CELL = {'value': None, 'formula': None, 'number_format': 'General', 'fill': None, 'protection': 'locked=True, hidden=False'}
+
+# compare two excel files cell by cell
+def diff_excel_files(expected_loc, actual_loc):
+    """
+    expected_loc - golden file,
+    actual_loc - produced file
+
+    returns list of differences
+    """
+    differences = []
+
+    with zipfile.ZipFile(expected_loc) as expected_zf, zipfile.ZipFile(actual_loc) as actual_zf:
+        expected_sheets = sorted(name for name in expected_zf.namelist() if name.startswith('xl/worksheets/sheet'))
+        actual_sheets = sorted(name for name in actual_zf.namelist() if name.startswith('xl/worksheets/sheet'))
+        if expected_sheets != actual_sheets:
+            differences.append(f'sheets: {expected_sheets} != {actual_sheets}')
+
+        expected_calculation, actual_calculation = read_calculation_properties(expected_zf), read_calculation_properties(actual_zf)
+        for key in sorted(set(expected_calculation) | set(actual_calculation)):
+            if expected_calculation.get(key) != actual_calculation.get(key):
+                differences.append(f'workbook calcPr {key}: {expected_calculation.get(key)!r} != {actual_calculation.get(key)!r}')
+
+        expected_styles, actual_styles = read_styles(expected_zf), read_styles(actual_zf)
+        expected_strings, actual_strings = read_shared_strings(expected_zf), read_shared_strings(actual_zf)
+
+        for sheet_name in sorted(set(expected_sheets) & set(actual_sheets)):
+            sheet = os.path.basename(sheet_name).replace('.xml', '')
+            expected_info, actual_info = {}, {}
+            expected_cells = iter_cells(expected_zf, sheet_name, expected_styles, expected_strings, expected_info)
+            actual_cells = iter_cells(actual_zf, sheet_name, actual_styles, actual_strings, actual_info)
+
+            # both sheets are in order of rows, merge them like sorted lists
+            expected_cell, actual_cell = next(expected_cells, None), next(actual_cells, None)
+            while expected_cell is not None or actual_cell is not None:
+                if actual_cell is None or (expected_cell is not None and expected_cell[0] < actual_cell[0]):
+                    address, expected, actual = expected_cell[1], expected_cell[2], EMPTY_CELL
+                    expected_cell = next(expected_cells, None)
+                elif expected_cell is None or actual_cell[0] < expected_cell[0]:
+                    address, expected, actual = actual_cell[1], EMPTY_CELL, actual_cell[2]
+                    actual_cell = next(actual_cells, None)
+                else:
+                    address, expected, actual = expected_cell[1], expected_cell[2], actual_cell[2]
+                    expected_cell, actual_cell = next(expected_cells, None), next(actual_cells, None)
+
+                for key, expected_value in expected.items():
+                    if expected_value != actual[key]:
+                        differences.append(f'{sheet}!{address} {key}: {expected_value!r} != {actual[key]!r}')
+
+            if sorted(expected_info['validations']) != sorted(actual_info['validations']):
+                differences.append(f"{sheet} validations: {expected_info['validations']} != {actual_info['validations']}")
+            if expected_info['protection'] != actual_info['protection']:
+                expected_protection, actual_protection = expected_info['protection'] or {}, actual_info['protection'] or {}
+                for key in sorted(set(expected_protection) | set(actual_protection)):
+                    if expected_protection.get(key) != actual_protection.get(key):
+                        differences.append(f'{sheet} protection {key}: {expected_protection.get(key)!r} != {actual_protection.get(key)!r}')
+
+    return differences
+
+# excel files of the directory and its subdirectories, relative to the directory
+def list_excel_files(directory):
+    excel_files = set()
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith('.xlsx'):
+                excel_files.add(os.path.relpath(os.path.join(root, name), directory))
+
+    return excel_files
+
+# compare excel files of two directories, or two excel files
+def diff_outputs(expected_loc, actual_loc, max_diffs=MAX_DIFFS):
+    """
+    expected_loc - golden directory or file,
+    actual_loc - produced directory or file,
+    max_diffs - how many differences are printed for each file
+
+    returns True when there are no differences
+    """
+    if os.path.isdir(expected_loc):
+        expected_files = list_excel_files(expected_loc)
+        actual_files = list_excel_files(actual_loc)
+        pairs = [(os.path.join(expected_loc, name), os.path.join(actual_loc, name)) for name in sorted(expected_files & actual_files)]
+    else:
+        expected_files, actual_files = set(), set()
+        pairs = [(expected_loc, actual_loc)]
+
+    same = True
+    for name in sorted(expected_files - actual_files):
+        print(f'missing: {name}')
+        same = False
+    for name in sorted(actual_files - expected_files):
+        print(f'unexpected: {name}')
+        same = False
+
+    for expected_file, actual_file in pairs:
+        differences = diff_excel_files(expected_file, actual_file)
+        if not differences:
+            continue
+
+        same = False
+        print(f'{os.path.relpath(actual_file, actual_loc) if os.path.isdir(actual_loc) else actual_file}: {len(differences)} differences')
+        for difference in differences[:max_diffs]:
+            print(f'    {difference}')
+        if len(differences) > max_diffs:
+            print(f'    ... and {len(differences) - max_diffs} more')
+
+    return same
+
+# run pipeline on fixture dataset and compare with golden files
+def check():
+    start_time = time.time()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        run_fixture(output_dir)
+        same = diff_outputs(GOLDEN_DIR, output_dir)
+
+    print(f"{'OK' if same else 'FAILED'} - {time.time() - start_time:.2f} seconds")
+
+    return same
+
+# replace golden files with output of the current code
+def update():
+    shutil.rmtree(GOLDEN_DIR, ignore_errors=True)
+
+    run_fixture(GOLDEN_DIR)
+
+    # only excel files are golden files
+    for root, _, names in os.walk(GOLDEN_DIR):
+        for name in names:
+            if not name.endswith('.xlsx'):
+                os.remove(os.path.join(root, name))
+
+    print(f'golden files updated: {GOLDEN_DIR}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='regression harness for request forms')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('check', help='run pipeline on fixture dataset and compare with golden files')
+    subparsers.add_parser('update', help='replace golden files with output of the current code')
+    diff_parser = subparsers.add_parser('diff', help='compare excel files of two runs')
+    diff_parser.add_argument('expected', help='directory or excel file')
+    diff_parser.add_argument('actual', help='directory or excel file')
+    diff_parser.add_argument('--max-diffs', type=int, default=MAX_DIFFS, help='how many differences are shown for each file')
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        same = check()
+    elif args.command == 'update':
+        update()
+        same = True
+    else:
+        same = diff_outputs(args.expected, args.actual, args.max_diffs)
+
+    sys.exit(0 if same else 1)
@@ -11,17 +11,23 @@ from openpyxl.styles import Alignment, Font, NamedStyle, PatternFill, Protection
 from openpyxl.worksheet.table import Table
 from openpyxl.worksheet.datavalidation import DataValidation
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import copy
 import time
-import traceback
 from datetime import datetime as dt
 import sys
+import os
+import re
+import json
+import zipfile
+import argparse
 
-# set up logging
-logging.basicConfig(level=logging.DEBUG, encoding= 'utf-8',
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S',
-                    filename='request_form.log',
-                    filemode='w')
+# logger of the script, handlers are set up by setup_logging
+logger = logging.getLogger('request_forms')
+
+# log file, one json object per line
+LOG_FILE = 'request_form.log'
 
 
 # file locations
@@ -36,6 +42,115 @@ ADJUST_CENTRAL_STORAGE_QUANTITY = r'D:\Tasks\yoyoso restock planning\restock bra
 # directory of branch files
 BRANCHES_DIR = r'D:\Tasks\yoyoso restock planning\restock branches\branches'
 
+# central storage
+CENTRAL_STORAGE_NAME = '1610011100 - ცენტრალური საწყობი (ლილო)'
+
+# filter warehouses
+# დროებით ამოღებულია '1610000100 - პიქსელი საწყობი'
+WAREHOUSES_OF_INTEREST = [
+    '1610000200 - მარჯანიშვილი საწყობი',
+    '1610000500 - ბათუმი საწყობი',
+    '1610010100 - პიქსელი - ფილიალი 1',
+    '1610011100 - ცენტრალური საწყობი (ლილო)',
+    '1610011400 - ისთ ფოინთი საწყობი',
+    '1610020100 - მარჯანიშვილი - ფილიალი 2',
+    '1610041100 - რუსთაველის - ფილიალი 8',
+    '1610041500 - რუსთაველი 8 საწყობი',
+    '1610050100 - ბათუმი მაღაზია',
+    '1610070100 - თბილისი მოლი - ფილიალი 7',
+    '1610071400 - თბილისი მოლი საწყობი',
+    '1610080100 - ბათუმი XS - ფილიალი',
+    '1610090100 - პეკინი',
+    '1610990100 - პეკინი საწყობი',
+    '1610100100 - ისთ ფოინთი - ფილიალი 10',
+    '1610110100 - ყაზბეგი',
+    '1610111400 - ყაზბეგი საწყობი']
+
+# pair warehouses
+# დროებით ამოღებულია '1610000100 - პიქსელი საწყობი', 
+WAREHOUSE_PAIRS = [
+    ['1610010100 - პიქსელი - ფილიალი 1'],
+    ['1610000200 - მარჯანიშვილი საწყობი', '1610020100 - მარჯანიშვილი - ფილიალი 2'],
+    ['1610000500 - ბათუმი საწყობი', '1610080100 - ბათუმი XS - ფილიალი'],
+    ['1610011400 - ისთ ფოინთი საწყობი', '1610100100 - ისთ ფოინთი - ფილიალი 10'],
+    ['1610041500 - რუსთაველი 8 საწყობი', '1610041100 - რუსთაველის - ფილიალი 8'],
+    ['1610050100 - ბათუმი მაღაზია'],
+    ['1610071400 - თბილისი მოლი საწყობი', '1610070100 - თბილისი მოლი - ფილიალი 7'],
+    ['1610111400 - ყაზბეგი საწყობი', '1610110100 - ყაზბეგი'],
+    ['1610090100 - პეკინი', '1610990100 - პეკინი საწყობი']
+    ]
+
+# min cogs for each branch
+MIN_DICTIONARY = {
+    "პიქსელი": 200000,
+    "ისთ ფოინთი": 170000,
+    "მარჯანიშვილი": 130000,
+    "პეკინი": 100000,
+    "თბილისი მოლი": 90000,
+    "ბათუმი მაღაზია": 160000,
+    "ბათუმი საწყობი": 30000,
+    "ყაზბეგი": 80000,
+    "რუსთაველი": 100000
+}
+
+# recommended share of each priority in the branch stock
+ABC_RECOMMENDATIONS = {'A': 0.2, 'B': 0.5, 'C': 0.2, 'D': 0.1}
+
+# keys of scenario config, see read_scenarios
+SCENARIO_KEYS = ['name', 'reserves', 'remove_codes', 'central_storage_name', 'output_dir']
+
+# column names of cleaned closing inventory
+CLOSING_INVENTORY_COLUMNS = ['warehouse', 'code', 'sku', 'product_name', 'category', 'type', 'cogs', 'quantity']
+
+# format log records as json lines with branch and stage fields
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'name': record.name,
+            'branch': getattr(record, 'branch', None),
+            'stage': getattr(record, 'stage', None),
+            'message': record.getMessage()
+        }
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        
+        return json.dumps(entry, ensure_ascii=False)
+
+# queue handler which leaves json formatting to the listener thread
+class JsonQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # merge arguments and traceback here, they may change before the listener writes the record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        
+        return record
+
+# push log records through a queue to a background writer, so callers never wait on the file
+def setup_logging(level=logging.DEBUG, log_file=LOG_FILE):
+    """
+    level - records below the level are dropped before they are formatted, 
+    log_file - file is overwritten on every run
+    
+    returns started listener, stop it before exit to flush the queue
+    """
+    file_handler = logging.FileHandler(log_file, mode='w', encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter(datefmt='%Y-%m-%d %H:%M:%S'))
+    
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    
+    logger.setLevel(level)
+    logger.addHandler(JsonQueueHandler(log_queue))
+    listener.start()
+    
+    return listener
+
 # get list of codes, that need to be removed
 def remove_codes(code_dir: str) -> pd.DataFrame:
     code_list = pd.read_excel(code_dir)
@@ -56,15 +171,14 @@ def adjust_central_storage(dir: str) -> pd.DataFrame:
     
     return adjust_quant_df
 
-# read csv files and clean data
-def prep_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_loc, product_description_loc, centr_strg_name, warehouse_list):
+# read csv files and clean data, shared by every scenario
+def load_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_loc, product_description_loc, warehouse_list):
     """
     product_evaluation, 
     sales_df, 
     inventory_df - closed inventory file, 
     closing_inventory, 
-    central_storage_df, 
-    share_of_sales_by_warehouses
+    product_description
     """
     
     # read csv files
@@ -94,8 +208,7 @@ def prep_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_
     closing_inventory = closing_inventory[remove_columns]
     
     # rename columns
-    column_names = ['warehouse', 'code', 'sku', 'product_name', 'category', 'type', 'cogs', 'quantity']
-    closing_inventory.columns = column_names
+    closing_inventory.columns = CLOSING_INVENTORY_COLUMNS
     
     # fill down warehouse
     closing_inventory.warehouse.ffill(inplace=True)
@@ -123,19 +236,36 @@ def prep_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_
        'პარფიუმერია', 'კოსმეტიკა']
 
     closing_inventory = closing_inventory[closing_inventory.category.isin(remove_categories)].reset_index(drop=True)
+    
+    # add box quant
+    closing_inventory = pd.merge(left=closing_inventory, right=product_description, on='code', how='left').reset_index(drop=False)
+    
+    return product_evaluation, sales_df, inventory_df, closing_inventory, product_description
 
+# apply scenario specific inputs (source warehouse and reserves) to the shared dataframes
+def scenario_dataframes(closing_inventory, sales_df, centr_strg_name, adjust_reserves_loc, excluded_warehouses=()):
+    """
+    closing_inventory - with box quant, 
+    sales_df, 
+    centr_strg_name - source warehouse, 
+    adjust_reserves_loc - reserves file, 
+    excluded_warehouses - warehouses without form, left out of shares of sales with the source warehouse
+    
+    returns central_storage_df, share_of_sales_by_warehouses
+    """
+    
     central_storage_df = closing_inventory.copy()[closing_inventory.warehouse == centr_strg_name].reset_index(drop=True)
     # adjust central storage quantities here
     try:
-        adjust_cs_quantities = adjust_central_storage(ADJUST_CENTRAL_STORAGE_QUANTITY)
-    except Exception as e:
-        logging('error during adjusting central storage quantities: {traceback.format_exc()}')
+        adjust_cs_quantities = adjust_central_storage(adjust_reserves_loc)
+    except Exception:
+        logger.error('error during adjusting central storage quantities', exc_info=True, extra={'stage': 'reserves'})
         raise
     
     try:
         central_storage_df = pd.merge(left=central_storage_df, right=adjust_cs_quantities, left_on='sku', right_on='შტრხკოდი', how='left')
-    except Exception as e:
-        print(f'Error: {traceback.format_exc()}')
+    except Exception:
+        logger.error('error during merging of central storage reserves', exc_info=True, extra={'stage': 'reserves'})
         raise
     
     central_storage_df['unit_cogs'] = central_storage_df['cogs'] / central_storage_df['quantity']
@@ -145,31 +275,48 @@ def prep_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_
     central_storage_df['quantity'] = central_storage_df['quantity'] - central_storage_df['not_removed']
     central_storage_df['cogs'] = central_storage_df['cogs'] - central_storage_df['adjust_cogs']
     
-    central_storage_df = central_storage_df[column_names]
-    
-    # remove later
-    central_storage_df.to_excel(r'D:\Tasks\yoyoso restock planning\restock branches\adjust reserves\check_result.xlsx')
-    
-    # add box quant
-    closing_inventory = pd.merge(left=closing_inventory, right=product_description, on='code', how='left').reset_index(drop=False)
+    central_storage_df = central_storage_df[CLOSING_INVENTORY_COLUMNS]
 
     # shares of sales by warehouses
     share_of_sales_by_warehouses = sales_df.groupby('warehouse').agg({
         'quantity': 'sum',
         'cogs': 'sum'
     }).reset_index(drop=False)
-    share_of_sales_by_warehouses = share_of_sales_by_warehouses[share_of_sales_by_warehouses.warehouse != centr_strg_name]
+    share_of_sales_by_warehouses = share_of_sales_by_warehouses[(share_of_sales_by_warehouses.warehouse != centr_strg_name) &
+                                                                (~share_of_sales_by_warehouses.warehouse.isin(excluded_warehouses))]
     # calculate share of sales between warehouses
     total_cogs = share_of_sales_by_warehouses['cogs'].sum()
 
     share_of_sales_by_warehouses['share'] = round(share_of_sales_by_warehouses['cogs'] / total_cogs,2)
     share_of_sales_by_warehouses.drop(columns=['cogs', 'quantity'], axis=1, inplace=True)
     
+    return central_storage_df, share_of_sales_by_warehouses
+
+# read csv files and clean data
+def prep_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_loc, product_description_loc, centr_strg_name, warehouse_list):
+    """
+    product_evaluation, 
+    sales_df, 
+    inventory_df - closed inventory file, 
+    closing_inventory, 
+    central_storage_df, 
+    share_of_sales_by_warehouses
+    """
+    
+    product_evaluation, sales_df, inventory_df, closing_inventory, product_description = \
+        load_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_loc, product_description_loc, warehouse_list)
+    
+    central_storage_df, share_of_sales_by_warehouses = \
+        scenario_dataframes(closing_inventory, sales_df, centr_strg_name, ADJUST_CENTRAL_STORAGE_QUANTITY)
+    
+    # remove later
+    central_storage_df.to_excel(r'D:\Tasks\yoyoso restock planning\restock branches\adjust reserves\check_result.xlsx')
+    
     return product_evaluation, sales_df, inventory_df, closing_inventory, product_description, central_storage_df, share_of_sales_by_warehouses
 
 
 # prepare form for each warehouse
-def request_form(warehouse_var, closing_inventory, central_storage_name, product_evaluation, sales_df, share_of_sales_by_warehouses, central_storage_df, product_description_df):
+def request_form(warehouse_var, closing_inventory, central_storage_name, product_evaluation, sales_df, share_of_sales_by_warehouses, central_storage_df, product_description_df, rmv_codes_list=None):
     """
     warehouse_var, 
     closing_inventory, 
@@ -177,7 +324,8 @@ def request_form(warehouse_var, closing_inventory, central_storage_name, product
     product_evaluation, 
     sales_df, 
     share_of_sales_by_warehouses, 
-    central_storage_df
+    central_storage_df, 
+    rmv_codes_list - codes to remove, read from REMOVE_CODES when not given
     """
     # product description part of the code
     temp_df = closing_inventory.copy().loc[(closing_inventory.warehouse == central_storage_name) |
@@ -382,7 +530,8 @@ def request_form(warehouse_var, closing_inventory, central_storage_name, product
     temp_df = temp_df[reorder_columns]
     
     # remove unnecessary codes
-    rmv_codes_list = remove_codes(REMOVE_CODES)
+    if rmv_codes_list is None:
+        rmv_codes_list = remove_codes(REMOVE_CODES)
     
     temp_df = temp_df[~temp_df['შიდა კოდი'].isin(rmv_codes_list.code)]
     
@@ -394,6 +543,137 @@ def calculate_last_row(dataframe):
     
     return last_row
 
+# calculate values of the summary block in pandas, same as formulas of the excel file before it is filled in
+def calculate_summary(dataframe, inventory_df, warehouse):
+    """
+    dataframe - final file, 
+    inventory_df - inventory with dates, 
+    warehouse - list of warehouses
+    """
+    # min cogs of the branch
+    min_quantity = None
+    for key, value in MIN_DICTIONARY.items():
+        if any(key in warehouse_name for warehouse_name in warehouse):
+            min_quantity = value
+            break
+    else:
+        logger.error('warehouses are not in min_dictionary list - %s', warehouse,
+                     extra={'branch': warehouse[0].split(' - ')[1], 'stage': 'summary'})
+    
+    max_capacity = round(min_quantity * 1.30, 2)
+    
+    # max cogs the branch has held historically
+    max_cogs_in_wh_df = inventory_df[inventory_df.warehouse.isin(warehouse)].groupby('date')['cogs'].sum().reset_index(drop=False)
+    max_cogs_wh = max_cogs_in_wh_df.cogs.max()
+    
+    # შევსება is empty, so განახლებული equals მარაგი რაოდენობა
+    updated = dataframe['მარაგი რაოდენობა']
+    total_quantity = dataframe['მარაგი რაოდენობა'].sum()
+    total_updated = updated.sum()
+    total_cogs = dataframe['მარაგი თვითღირ.'].sum()
+    quantity_by_priority = dataframe.groupby('პრიორიტეტულობა')['მარაგი რაოდენობა'].sum()
+    updated_by_priority = updated.groupby(dataframe['პრიორიტეტულობა']).sum()
+    
+    abcd = {}
+    for priority, recommendation in ABC_RECOMMENDATIONS.items():
+        abcd[priority] = {
+            'recommendation': recommendation,
+            'current': float(quantity_by_priority.get(priority, 0) / total_quantity) if total_quantity else None,
+            'updated': float(updated_by_priority.get(priority, 0) / total_updated) if total_updated else None
+        }
+    
+    updated_stock = float(total_cogs / total_quantity * total_updated) if total_quantity else None
+    
+    summary = {
+        'branch': warehouse[0].split(' - ')[1],
+        'warehouses': list(warehouse),
+        'abcd': abcd,
+        'max_capacity': max_capacity,
+        'min_quantity': min_quantity,
+        'max_cogs': None if pd.isna(max_cogs_wh) else float(max_cogs_wh),
+        'updated_stock': updated_stock,
+        'min_fill': None if updated_stock is None else min_quantity - updated_stock,
+        'max_fill': None if updated_stock is None else max_capacity - updated_stock
+    }
+    
+    return summary
+
+# values of formula cells, written as cached values so excel does not need to recalculate on open
+def cached_formula_values(dataframe, summary):
+    """
+    dataframe - final file, 
+    summary - summary of the branch, see calculate_summary
+    """
+    cached_values = {}
+    
+    # განახლებული = შევსება + მარაგი რაოდენობა, შევსება is empty
+    for row, value in enumerate(dataframe['მარაგი რაოდენობა'], start=22):
+        cached_values[f'P{row}'] = value
+    
+    for row, priority in enumerate(ABC_RECOMMENDATIONS.keys(), start=5):
+        cached_values[f'E{row}'] = summary['abcd'][priority]['current']
+        cached_values[f'F{row}'] = summary['abcd'][priority]['updated']
+    
+    cached_values['D13'] = summary['updated_stock']
+    cached_values['D14'] = summary['min_fill']
+    cached_values['D15'] = summary['max_fill']
+    
+    # cells that would be an error in excel have no value (None), they are left for excel to calculate
+    return {address: None if value is None or pd.isna(value) else value for address, value in cached_values.items()}
+
+# write cached values into formula cells of saved excel file
+def write_cached_values(file_loc, cached_values):
+    """
+    file_loc - saved excel file, 
+    cached_values - dictionary of cell address and value, see cached_formula_values
+    
+    returns True when every formula cell got its value and excel is told not to recalculate on open
+    """
+    sheet_name = 'xl/worksheets/sheet1.xml'
+    workbook_name = 'xl/workbook.xml'
+    # openpyxl writes formula cells with empty value
+    formula_cell = re.compile(r'<c r="([A-Z]+[0-9]+)"([^>]*)><f>(.*?)</f>(?:<v\s*/>|<v></v>)</c>')
+    calculation_properties = re.compile(r'<calcPr[^>]*/>')
+    patched = set()
+    
+    def add_value(match):
+        address, attributes, formula = match.groups()
+        if cached_values.get(address) is None:
+            return match.group(0)
+        patched.add(address)
+        return f'<c r="{address}"{attributes}><f>{formula}</f><v>{repr(float(cached_values[address]))}</v></c>'
+    
+    with zipfile.ZipFile(file_loc) as source:
+        items = [(item, source.read(item.filename)) for item in source.infolist()]
+    
+    items = [(item, formula_cell.sub(add_value, data.decode('utf-8')).encode('utf-8') if item.filename == sheet_name else data)
+             for item, data in items]
+    
+    # cells without value (see cached_formula_values) or not patched are calculated only when excel recalculates the whole file on open
+    expected = {address for address, value in cached_values.items() if value is not None}
+    all_cached = len(expected) == len(cached_values) and patched == expected
+    if patched != expected:
+        logger.warning('%s - cached values written to %s of %s formula cells, excel recalculates the file on open',
+                       file_loc, len(patched), len(expected), extra={'stage': 'save'})
+    elif not all_cached:
+        logger.info('%s - %s formula cells have no cached value, excel recalculates the file on open',
+                    file_loc, len(cached_values) - len(expected), extra={'stage': 'save'})
+    else:
+        # values are already calculated, excel should not recalculate every formula on open.
+        # excel also recalculates files saved by older calculation engine, openpyxl default calcId is of excel 2007
+        items = [(item, calculation_properties.sub('<calcPr calcId="191029" fullCalcOnLoad="0" />', data.decode('utf-8'), count=1).encode('utf-8')
+                  if item.filename == workbook_name else data)
+                 for item, data in items]
+    
+    temp_loc = file_loc + '.tmp'
+    with zipfile.ZipFile(temp_loc, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item, data in items:
+            target.writestr(item, data)
+    
+    os.replace(temp_loc, file_loc)
+    
+    return all_cached
+
 # create excel file and format it
 def initiate_excel_file():
     wb = Workbook()
@@ -508,14 +788,13 @@ def format_excel_file(ws, last_row, warehouse):
     ws.column_dimensions['J'].hidden = True
 
 # fill in values
-def populate_excel_file(ws, last_row, dataframe, inventory_df, warehouse):
+def populate_excel_file(ws, last_row, dataframe, summary):
     
     """
     ws - active sheet,
     last_row - calculate last_row,
     dataframe - final file,
-    inventory_df - inventory with dates,
-    warehouse - list of warehouses
+    summary - summary of the branch, see calculate_summary
     """
     start_row = 21
     start_column = 3
@@ -566,8 +845,8 @@ def populate_excel_file(ws, last_row, dataframe, inventory_df, warehouse):
         cell.font = subsection_headers_styles
 
     # populate abc subsection
-    abc_abc_names = ['A', 'B', 'C', 'D']
-    abc_recommendations = [0.2, 0.5, 0.2, 0.1]
+    abc_abc_names = list(ABC_RECOMMENDATIONS.keys())
+    abc_recommendations = list(ABC_RECOMMENDATIONS.values())
 
     # Assigning values to cells in column C (C6:C9) for abc_abc_names
     for i, value in enumerate(abc_abc_names, start=5):  # Starting from row 6
@@ -593,37 +872,14 @@ def populate_excel_file(ws, last_row, dataframe, inventory_df, warehouse):
         cell.style = percent_style
 
     # recommendation about how many products to add
-    max_cogs_in_wh_df = inventory_df[inventory_df.warehouse.isin(warehouse)].groupby('date')['cogs'].sum().reset_index(drop=False)
-    max_cogs_wh = max_cogs_in_wh_df.cogs.max()
-
     ws["C11"].value = "მაქს ტევადობა"
     ws["C12"].value = "მინ რაოდენობა"
     ws["C13"].value = "განახლებული ნაშთი"
     ws["C14"].value = "მინ შესავსები"
     ws["C15"].value = "მაქს შესავსები"
 
-    # min cogs for each branch
-    min_dictionary = {
-        "პიქსელი": 200000,
-        "ისთ ფოინთი": 170000,
-        "მარჯანიშვილი": 130000,
-        "პეკინი": 100000,
-        "თბილისი მოლი": 90000,
-        "ბათუმი მაღაზია": 160000,
-        "ბათუმი საწყობი": 30000,
-        "ყაზბეგი": 80000,
-        "რუსთაველი": 100000
-    }
-
-    # set values
-    for key, value in min_dictionary.items():
-        if any(key in warehouse_name for warehouse_name in warehouse):
-            ws["D12"].value = value
-            break
-        else:
-            logging.error(f'Warehouse name - {key} - not in min_dictionary list - {warehouse}')
-    
-    ws["D11"].value = round(ws["D12"].value * 1.30, 2)
+    ws["D12"].value = summary['min_quantity']
+    ws["D11"].value = summary['max_capacity']
     
     ws["D13"].value = '=(SUM(table[მარაგი თვითღირ.]) / SUM(table[მარაგი რაოდენობა])) * SUM(table[განახლებული])'
     ws['D14'].value = '=D12 - D13'
@@ -640,104 +896,215 @@ def populate_excel_file(ws, last_row, dataframe, inventory_df, warehouse):
     ws["C19"].value = "A - მაღალი მოგება, B - საშუალო, C- დაბალი"
     """
 # save excel file
-def save_excel_file(wb, warehouse):
+def save_excel_file(wb, warehouse, branches_dir=BRANCHES_DIR, cached_values=None):
     file_name = warehouse[0].split(' - ')[1]
-    wb.save(f'{BRANCHES_DIR}\{file_name}.xlsx')
-
-def main():
+    file_loc = os.path.join(branches_dir, f'{file_name}.xlsx')
     
-    start_time = time.time()
+    wb.save(file_loc)
     
-    # central storage
-    central_storage_name = '1610011100 - ცენტრალური საწყობი (ლილო)'
+    if cached_values:
+        write_cached_values(file_loc, cached_values)
 
-    # filter warehouses
-    # დროებით ამოღებულია '1610000100 - პიქსელი საწყობი'
-    warehouses_of_interest = [
-    '1610000200 - მარჯანიშვილი საწყობი',
-    '1610000500 - ბათუმი საწყობი',
-    '1610010100 - პიქსელი - ფილიალი 1',
-    '1610011100 - ცენტრალური საწყობი (ლილო)',
-    '1610011400 - ისთ ფოინთი საწყობი',
-    '1610020100 - მარჯანიშვილი - ფილიალი 2',
-    '1610041100 - რუსთაველის - ფილიალი 8',
-    '1610041500 - რუსთაველი 8 საწყობი',
-    '1610050100 - ბათუმი მაღაზია',
-    '1610070100 - თბილისი მოლი - ფილიალი 7',
-    '1610071400 - თბილისი მოლი საწყობი',
-    '1610080100 - ბათუმი XS - ფილიალი',
-    '1610090100 - პეკინი',
-    '1610990100 - პეკინი საწყობი',
-    '1610100100 - ისთ ფოინთი - ფილიალი 10',
-    '1610110100 - ყაზბეგი',
-    '1610111400 - ყაზბეგი საწყობი']
+# save summary of the branch as json, dashboards can read it without opening excel file
+def save_summary(summary, branches_dir=BRANCHES_DIR):
+    with open(os.path.join(branches_dir, f"{summary['branch']}.json"), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
 
-    # pair warehouses
-    # დროებით ამოღებულია '1610000100 - პიქსელი საწყობი', 
-    warehouse_pairs = [
-        ['1610010100 - პიქსელი - ფილიალი 1'],
-        ['1610000200 - მარჯანიშვილი საწყობი', '1610020100 - მარჯანიშვილი - ფილიალი 2'],
-        ['1610000500 - ბათუმი საწყობი', '1610080100 - ბათუმი XS - ფილიალი'],
-        ['1610011400 - ისთ ფოინთი საწყობი', '1610100100 - ისთ ფოინთი - ფილიალი 10'],
-        ['1610041500 - რუსთაველი 8 საწყობი', '1610041100 - რუსთაველის - ფილიალი 8'],
-        ['1610050100 - ბათუმი მაღაზია'],
-        ['1610071400 - თბილისი მოლი საწყობი', '1610070100 - თბილისი მოლი - ფილიალი 7'],
-        ['1610111400 - ყაზბეგი საწყობი', '1610110100 - ყაზბეგი'],
-        ['1610090100 - პეკინი', '1610990100 - პეკინი საწყობი']
-        ]
-
-    try:
-        product_evaluation, sales_df, inventory_df, closing_inventory, product_description_df, central_storage_df, share_of_sales_by_warehouses = \
-            prep_dataframes(EVALUATION_LOC, SALES_LOC, INVENTORY_LOC, CLOSING_INVENTORY, PRODUCT_DESCRIPTION, central_storage_name, warehouses_of_interest)
-    except Exception as e:
-        logging.warning(f'Problem with preparation of dataframes - {e}')
+# save summaries of all branches as one csv file
+def save_summaries_csv(summaries, branches_dir=BRANCHES_DIR):
+    rows = []
+    for summary in summaries:
+        row = {key: value for key, value in summary.items() if key not in ('warehouses', 'abcd')}
+        for priority, shares in summary['abcd'].items():
+            for name, share in shares.items():
+                row[f'{priority}_{name}'] = share
+        rows.append(row)
+    
+    pd.DataFrame(rows).to_csv(os.path.join(branches_dir, 'summary.csv'), index=False, encoding='utf-8-sig')
 
+# prepare, format and save request forms of every warehouse pair
+def prepare_branch_forms(warehouse_pairs, central_storage_name, product_evaluation, sales_df, inventory_df, closing_inventory,
+                         product_description_df, central_storage_df, share_of_sales_by_warehouses, rmv_codes_list, branches_dir, start_time):
+    """
+    warehouse_pairs - list of warehouses lists, one form per list, 
+    rmv_codes_list - codes to remove, 
+    branches_dir - directory where forms are saved, 
+    start_time - used for logging of execution time
+    """
+    summaries = []
     for w in warehouse_pairs:
-        logging.info(f'preparing warehouses: {w}')
+        branch = w[0].split(' - ')[1]
+        logger.info('preparing warehouses: %s', w, extra={'branch': branch, 'stage': 'start'})
         try:
-            details = request_form(w, closing_inventory, central_storage_name, product_evaluation, sales_df, share_of_sales_by_warehouses, central_storage_df, product_description_df)
-        except Exception as e:
-            logging.warning(f'error in request form preperation: {e}')
-            logging.warning(f'failed: {w} - {traceback.format_exc()}')
-            break
+            details = request_form(w, closing_inventory, central_storage_name, product_evaluation, sales_df, share_of_sales_by_warehouses, central_storage_df, product_description_df, rmv_codes_list)
+        except Exception:
+            logger.warning('error in request form preperation - %s', w, exc_info=True, extra={'branch': branch, 'stage': 'request_form'})
+            continue
         
         last_row = calculate_last_row(details)
         
         try:
             ws, wb = initiate_excel_file()
-        except Exception as e:
-            logging.warning((f'Problem with initiating excel file - {e}'))
-            logging.warning(f'failed: {w} - {traceback.format_exc()}')
-            break
+        except Exception:
+            logger.warning('Problem with initiating excel file - %s', w, exc_info=True, extra={'branch': branch, 'stage': 'initiate'})
+            continue
         
         # details = details.loc[:, ~details.columns.isin(['ყუთში რაოდენობა'])]
         
         try:
-            populate_excel_file(ws, last_row, details, inventory_df, w)
-        except Exception as e:
-            logging.warning(f'Problem with population of excel file - {e}')
-            logging.warning(f'failed: {w}')
-            break
+            summary = calculate_summary(details, inventory_df, w)
+        except Exception:
+            logger.warning('Problem with calculation of summary - %s', w, exc_info=True, extra={'branch': branch, 'stage': 'summary'})
+            continue
+        
+        try:
+            populate_excel_file(ws, last_row, details, summary)
+        except Exception:
+            logger.warning('Problem with population of excel file - %s', w, exc_info=True, extra={'branch': branch, 'stage': 'populate'})
+            continue
         
         try:
             format_excel_file(ws, last_row, w)
-        except Exception as e:
-            logging.warning(f'Problem with formating of excel file - {e} - {traceback.format_exc()}')
-            logging.warning(f'failed: {w}')
-            break
+        except Exception:
+            logger.warning('Problem with formating of excel file - %s', w, exc_info=True, extra={'branch': branch, 'stage': 'format'})
+            continue
         
         try:
-            save_excel_file(wb, w)
-        except Exception as e:
-            logging.warning(f'Problem with saving of excel file - {e}')
-            logging.warning(f'failed: {w}')
-            break
+            save_excel_file(wb, w, branches_dir, cached_formula_values(details, summary))
+            save_summary(summary, branches_dir)
+        except Exception:
+            logger.warning('Problem with saving of excel file - %s', w, exc_info=True, extra={'branch': branch, 'stage': 'save'})
+            continue
         
-        logging.info(f'{w} - prepared')
+        summaries.append(summary)
+        
+        logger.info('%s - prepared', w, extra={'branch': branch, 'stage': 'done'})
         
         end_time = time.time()
         passed_time = end_time - start_time
-        logging.info(f"Execution time: {passed_time:.2f} seconds")
+        logger.info('Execution time: %.2f seconds', passed_time, extra={'branch': branch, 'stage': 'done'})
+    
+    try:
+        save_summaries_csv(summaries, branches_dir)
+    except Exception:
+        logger.warning('Problem with saving of summary', exc_info=True, extra={'stage': 'save'})
+
+def main():
+    
+    start_time = time.time()
+    
+    central_storage_name = CENTRAL_STORAGE_NAME
+
+    try:
+        product_evaluation, sales_df, inventory_df, closing_inventory, product_description_df, central_storage_df, share_of_sales_by_warehouses = \
+            prep_dataframes(EVALUATION_LOC, SALES_LOC, INVENTORY_LOC, CLOSING_INVENTORY, PRODUCT_DESCRIPTION, central_storage_name, WAREHOUSES_OF_INTEREST)
+        rmv_codes_list = remove_codes(REMOVE_CODES)
+    except Exception:
+        logger.warning('Problem with preparation of dataframes', exc_info=True, extra={'stage': 'prepare'})
+        return
+
+    prepare_branch_forms(WAREHOUSE_PAIRS, central_storage_name, product_evaluation, sales_df, inventory_df, closing_inventory,
+                         product_description_df, central_storage_df, share_of_sales_by_warehouses, rmv_codes_list, BRANCHES_DIR, start_time)
+
+# read scenario configs from json file
+def read_scenarios(scenarios_loc):
+    """
+    scenarios_loc - json file with list of scenarios, each scenario is a dictionary with keys:
+        name - required, used as name of output directory, 
+        reserves - optional, defaults to ADJUST_CENTRAL_STORAGE_QUANTITY, 
+        remove_codes - optional, defaults to REMOVE_CODES, 
+        central_storage_name - optional, defaults to CENTRAL_STORAGE_NAME, 
+        output_dir - optional, defaults to BRANCHES_DIR/name
+    """
+    with open(scenarios_loc, encoding='utf-8') as f:
+        scenarios = json.load(f)
+    
+    check_scenarios(scenarios)
+    
+    return scenarios
+
+# reject scenarios with missing names or unknown keys, a typo would silently fall back to the default file
+def check_scenarios(scenarios):
+    for scenario in scenarios:
+        if 'name' not in scenario:
+            raise ValueError(f'scenario without name - {scenario}')
+        
+        unknown_keys = set(scenario) - set(SCENARIO_KEYS)
+        if unknown_keys:
+            raise ValueError(f"unknown keys in scenario {scenario['name']} - {sorted(unknown_keys)}, expected keys - {SCENARIO_KEYS}")
+    
+    names = [scenario['name'] for scenario in scenarios]
+    if len(names) != len(set(names)):
+        raise ValueError(f'scenario names must be unique - {names}')
+
+# prepare forms for several scenarios, heavy files are read only once
+def batch(scenarios, evaluation_loc=EVALUATION_LOC, sales_loc=SALES_LOC, inventory_loc=INVENTORY_LOC,
+          closing_inventory_loc=CLOSING_INVENTORY, product_description_loc=PRODUCT_DESCRIPTION):
+    """
+    scenarios - list of scenario dictionaries, see read_scenarios, 
+    evaluation_loc, sales_loc, inventory_loc, closing_inventory_loc, product_description_loc - shared input files
+    """
+    check_scenarios(scenarios)
+    
+    start_time = time.time()
+    
+    # keep source warehouses of every scenario in closing inventory
+    warehouse_list = WAREHOUSES_OF_INTEREST + [scenario['central_storage_name'] for scenario in scenarios
+                                               if scenario.get('central_storage_name', CENTRAL_STORAGE_NAME) not in WAREHOUSES_OF_INTEREST]
+    
+    product_evaluation, sales_df, inventory_df, closing_inventory, product_description_df = \
+        load_dataframes(evaluation_loc, sales_loc, inventory_loc, closing_inventory_loc, product_description_loc, warehouse_list)
+    
+    logger.info('Shared dataframes loaded: %.2f seconds', time.time() - start_time, extra={'stage': 'prepare'})
+    
+    source_warehouses = set(closing_inventory.warehouse.unique())
+    
+    for scenario in scenarios:
+        name = scenario['name']
+        central_storage_name = scenario.get('central_storage_name', CENTRAL_STORAGE_NAME)
+        branches_dir = scenario.get('output_dir', os.path.join(BRANCHES_DIR, name))
+        
+        logger.info('preparing scenario: %s', name, extra={'stage': 'scenario'})
+        if central_storage_name not in source_warehouses:
+            logger.warning('scenario %s is skipped - source warehouse %s is not in closing inventory', name, central_storage_name,
+                           extra={'stage': 'scenario'})
+            continue
+        
+        # source warehouse can not restock itself, its branch is left out of the scenario
+        warehouse_pairs = [w for w in WAREHOUSE_PAIRS if central_storage_name not in w]
+        skipped_warehouses = [warehouse for w in WAREHOUSE_PAIRS if central_storage_name in w for warehouse in w]
+        if skipped_warehouses:
+            logger.warning('scenario %s - %s is the source warehouse, form is not prepared for %s', name, central_storage_name, skipped_warehouses,
+                           extra={'branch': skipped_warehouses[0].split(' - ')[1], 'stage': 'scenario'})
+        
+        try:
+            # warehouses without form get no share of the source stock, default central storage is never a branch
+            central_storage_df, share_of_sales_by_warehouses = \
+                scenario_dataframes(closing_inventory, sales_df, central_storage_name,
+                                    scenario.get('reserves', ADJUST_CENTRAL_STORAGE_QUANTITY),
+                                    skipped_warehouses + [CENTRAL_STORAGE_NAME])
+            rmv_codes_list = remove_codes(scenario.get('remove_codes', REMOVE_CODES))
+            os.makedirs(branches_dir, exist_ok=True)
+        except Exception:
+            logger.warning('Problem with preparation of scenario %s', name, exc_info=True, extra={'stage': 'scenario'})
+            continue
+        
+        prepare_branch_forms(warehouse_pairs, central_storage_name, product_evaluation, sales_df, inventory_df, closing_inventory,
+                             product_description_df, central_storage_df, share_of_sales_by_warehouses, rmv_codes_list, branches_dir, start_time)
+        
+        logger.info('scenario %s - prepared', name, extra={'stage': 'scenario'})
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='prepare excel request forms for branches')
+    parser.add_argument('--batch', metavar='SCENARIOS', help='json file with scenarios, prepares forms for each scenario in its own directory')
+    parser.add_argument('--log-level', default='DEBUG', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='records below the level are not logged')
+    args = parser.parse_args()
+    
+    listener = setup_logging(args.log_level)
+    try:
+        if args.batch:
+            batch(read_scenarios(args.batch))
+        else:
+            main()
+    finally:
+        listener.stop()